@@ -1,23 +1,42 @@
 import os
 import re
 import shutil
+import subprocess
+from gzip import GzipFile
+from threading import BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import mkdtemp
 from zipfile import ZipFile
 from tarfile import TarFile
-from robobrowser import RoboBrowser
-
-
-# this hack makes TarFile behave identically to ZipFile. I know, I'm a bad person.
-TarFile.namelist = TarFile.getnames
+from urllib.parse import urljoin
+import requests
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 
 
 LOGIN_PAGE = 'https://id.atlassian.com/login'
 MY_ATLASSIAN = 'https://my.atlassian.com'
 SOURCE_DOWNLOAD_BASE = MY_ATLASSIAN + '/download/source'
+ARCHIVE_TYPES = frozenset(['tar', 'zip'])
+DOWNLOAD_BUFFER_SIZE = 256 * 1024
+HTML_PARSER = 'lxml'
+EXTRACTION_WORKERS = os.cpu_count() or 1
+# members bigger than this are written out inline rather than held in memory for the writer pool
+PARALLEL_EXTRACTION_MAX_SIZE = 1024 * 1024
+# the system tar (and pigz, if present) unpack much faster than tarfile, which is only a fallback
+TAR_PATH = shutil.which('tar')
+PIGZ_PATH = shutil.which('pigz')
+
 
+# every request goes to the same couple of hosts, so keep the connections around between them
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=10))
+# requests already asks for compressed pages with every encoding it can decode, so just say who we are
+_SESSION.headers['User-Agent'] = 'atlas-source-gen/0.1.0'
 
-VERSION_EXTRACT_REGEX = re.compile(r'^(?P<version>(\d+)\.(\d+)\.(\d+)?)' +
-                                   r' Source \((?P<type>(ZIP|(TAR\.GZ)))( Archive)?\)$')
+
+# rows are filtered on their archive type suffix before this is run, so it only needs the version
+VERSION_EXTRACT_REGEX = re.compile(r'^(?P<version>(\d+)\.(\d+)\.(\d+)?) Source \(')
 
 
 class AtlassianSourceDownloadError(Exception):
@@ -33,7 +52,7 @@ def select_archive_type(app, provided_type):
     archive_type = provided_type
     if isinstance(archive_type, str):
         archive_type = archive_type.lower()
-    if archive_type not in ['tar', 'zip']:
+    if archive_type not in ARCHIVE_TYPES:
         # todo: spit out warning about this
         archive_type = None
     if archive_type is None:
@@ -49,6 +68,11 @@ def get_archive_extension(archive_type):
     return {'tar': 'tar.gz', 'zip': 'zip'}.get(archive_type.lower())
 
 
+def get_version_row_suffixes(archive_type):
+    archive_label = get_archive_extension(archive_type).upper()
+    return (' Source (%s)' % archive_label, ' Source (%s Archive)' % archive_label)
+
+
 def get_archive_object(archive_type, archive_path):
     if archive_type == 'tar':
         return TarFile.open(archive_path, 'r:gz')
@@ -57,88 +81,287 @@ def get_archive_object(archive_type, archive_path):
     raise AtlassianSourceArchiveError("'%s' is not an accepted archive type." % archive_type)
 
 
+def get_page(session, url):
+    response = session.get(url)
+    return response, BeautifulSoup(response.text, HTML_PARSER)
+
+
+def get_form_fields(form):
+    # collect the values a browser would send if the form were submitted as-is
+    fields = {}
+    for field in form.find_all('input'):
+        name = field.get('name')
+        if name is None:
+            continue
+        if field.get('type', '').lower() in ['checkbox', 'radio'] and not field.has_attr('checked'):
+            continue
+        fields[name] = field.get('value', '')
+    return fields
+
+
+def log_in(session, username, password):
+    response, page = get_page(session, LOGIN_PAGE)
+    login_form = page.find('form', id='form-login')
+    if login_form is None:
+        raise IOError("Login form not found on Atlassian ID service.")
+    fields = get_form_fields(login_form)
+    fields['username'] = username
+    fields['password'] = password
+    action_url = urljoin(response.url, login_form.get('action', ''))
+    if login_form.get('method', 'get').lower() == 'post':
+        response = session.post(action_url, data=fields)
+    else:
+        response = session.get(action_url, params=fields)
+    if response.status_code != 200:
+        raise IOError("Login failed to Atlassian ID service.")
+
+
+class TeeReader(object):
+    # passes reads through from a stream while copying everything read into a second file
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.sink.write(data)
+        return data
+
+
+def open_download(session, url):
+    response = session.get(url, stream=True)
+    response.raise_for_status()
+    # undo any transfer encoding so that we only ever see the archive bytes
+    response.raw.decode_content = True
+    return response
+
+
+def download_archive(session, url, archive_path):
+    response = open_download(session, url)
+    try:
+        with open(archive_path, 'wb') as archive_file:
+            # iter_content reports dropped connections as requests errors, unlike reading response.raw
+            for chunk in response.iter_content(DOWNLOAD_BUFFER_SIZE):
+                archive_file.write(chunk)
+    except Exception:
+        # don't leave a partial archive behind to be picked up by the next run
+        if os.path.isfile(archive_path):
+            os.unlink(archive_path)
+        raise
+    finally:
+        response.close()
+
+
+def stream_tar_archive(session, url, extraction_dir, archive_path=None):
+    response = open_download(session, url)
+    try:
+        if archive_path is None:
+            unpack_tar_stream(response.raw, extraction_dir)
+        else:
+            with open(archive_path, 'wb') as archive_file:
+                unpack_tar_stream(TeeReader(response.raw, archive_file), extraction_dir)
+                # unpacking can stop at the end-of-archive marker, so copy whatever is left
+                shutil.copyfileobj(response.raw, archive_file, DOWNLOAD_BUFFER_SIZE)
+    except Exception:
+        if archive_path is not None and os.path.isfile(archive_path):
+            os.unlink(archive_path)
+        raise
+    finally:
+        response.close()
+
+
+def write_tar_member(member_path, member, data):
+    with open(member_path, 'wb') as member_file:
+        member_file.write(data)
+    os.chmod(member_path, member.mode)
+    os.utime(member_path, (member.mtime, member.mtime))
+
+
+def extract_tar_members(src, extraction_dir):
+    # the tar stream has to be read in order on this thread, but the thousands of small source files
+    # in it can be written out by a pool of threads while the next members are being decompressed
+    extraction_root = os.path.realpath(extraction_dir)
+    write_slots = BoundedSemaphore(EXTRACTION_WORKERS * 4)
+    pending_writes = {}
+    directories = []
+    with ThreadPoolExecutor(max_workers=EXTRACTION_WORKERS) as writer_pool:
+        for member in src:
+            member_path = os.path.join(extraction_root, member.name)
+            # resolve symlinks unpacked earlier as well, since writing the file would follow them
+            resolved_path = os.path.realpath(member_path)
+            if resolved_path == extraction_root:
+                # the './' entry of a tarball made from inside its directory - nothing to unpack
+                continue
+            if not resolved_path.startswith(extraction_root + os.path.sep):
+                raise AtlassianSourceDownloadError("Archive member '%s' is outside of the archive."
+                                                   % member.name)
+            if member.isdir():
+                os.makedirs(member_path, exist_ok=True)
+                directories.append((member_path, member))
+            elif member.isfile() and member.size <= PARALLEL_EXTRACTION_MAX_SIZE:
+                os.makedirs(os.path.dirname(member_path), exist_ok=True)
+                data = src.extractfile(member).read()
+                # a path that appears twice has to end up with the later member, as with extractall
+                if resolved_path in pending_writes:
+                    pending_writes.pop(resolved_path).result()
+                write_slots.acquire()
+                write = writer_pool.submit(write_tar_member, member_path, member, data)
+                write.add_done_callback(lambda _: write_slots.release())
+                pending_writes[resolved_path] = write
+            else:
+                # links may point at files that are still queued, so let the writes catch up first
+                for write in pending_writes.values():
+                    write.result()
+                pending_writes = {}
+                src.extract(member, extraction_root)
+        for write in pending_writes.values():
+            write.result()
+    # like extractall, set directory attributes last (deepest first) so that a read-only directory
+    # doesn't stop its contents from being written
+    directories.sort(key=lambda directory: directory[1].name, reverse=True)
+    for directory_path, directory in directories:
+        os.chmod(directory_path, directory.mode)
+        os.utime(directory_path, (directory.mtime, directory.mtime))
+
+
+def get_tar_command(archive_path, extraction_dir):
+    if PIGZ_PATH is not None:
+        decompression_option = '--use-compress-program=%s' % PIGZ_PATH
+    else:
+        decompression_option = '-z'
+    return [TAR_PATH, '-x', decompression_option, '-f', archive_path, '-C', extraction_dir]
+
+
+def check_tar_result(exit_code):
+    if exit_code != 0:
+        raise AtlassianSourceDownloadError("Couldn't unpack archive - tar exited with code %d."
+                                           % exit_code)
+
+
+def extract_gzipped_tar_members(src, gzip_file, extraction_dir):
+    extract_tar_members(src, extraction_dir)
+    # tarfile stops at the end-of-archive marker, so read on to have gzip check the CRC and length
+    # in its trailer - otherwise a truncated archive would unpack as if it were complete
+    while gzip_file.read(DOWNLOAD_BUFFER_SIZE):
+        pass
+
+
+def unpack_tar_stream(fileobj, extraction_dir):
+    if TAR_PATH is None:
+        # tarfile's own 'r|gz' stream mode doesn't verify the end of the gzip stream, GzipFile does
+        with GzipFile(fileobj=fileobj, mode='rb') as gzip_file, \
+                TarFile.open(fileobj=gzip_file, mode='r|') as src:
+            extract_gzipped_tar_members(src, gzip_file, extraction_dir)
+        return
+    with subprocess.Popen(get_tar_command('-', extraction_dir), stdin=subprocess.PIPE,
+                          bufsize=0) as tar_process:
+        try:
+            shutil.copyfileobj(fileobj, tar_process.stdin, DOWNLOAD_BUFFER_SIZE)
+        except BrokenPipeError:
+            # tar stopped reading early, its exit code will say why
+            pass
+    check_tar_result(tar_process.returncode)
+
+
+def extract_tar_file(archive_path, extraction_dir):
+    if TAR_PATH is None:
+        # the archive is seekable on disk, so there's no need for tarfile's stream mode here
+        extract_archive('tar', archive_path, extraction_dir)
+        return
+    check_tar_result(subprocess.call(get_tar_command(archive_path, extraction_dir)))
+
+
+def extract_archive(archive_type, archive_path, extraction_dir):
+    with get_archive_object(archive_type, archive_path) as src:
+        if archive_type == 'tar':
+            extract_gzipped_tar_members(src, src.fileobj, extraction_dir)
+        else:
+            src.extractall(extraction_dir)
+
+
 def get_source(app, version, username, password,
                base_unpack_dir=None, clean=True, keep=True, archive_type=None):
-    browser = RoboBrowser()
-    # log in to the MyAtlassian portal
-    browser.open(LOGIN_PAGE)
-    login_form = browser.get_form(id='form-login')
-    login_form['username'].value = username
-    login_form['password'].value = password
-    browser.submit_form(login_form)
-    if browser.response.status_code != 200:
-        raise IOError("Login failed to Atlassian ID service.")
+    # log in to the MyAtlassian portal, dropping any login left over from a previous call
+    _SESSION.cookies.clear()
+    log_in(_SESSION, username, password)
     # get the list of versions for the application we're wanting to download source for
-    browser.open("%s/%s" % (SOURCE_DOWNLOAD_BASE, app))
-    versions = browser.select('table#source-download-table tr.smallish')
-    row_number = 0
-    version_download_map = {}
+    _, versions_page = get_page(_SESSION, "%s/%s" % (SOURCE_DOWNLOAD_BASE, app))
+    versions_table = versions_page.select_one('table#source-download-table')
+    versions = [] if versions_table is None else versions_table.select('tr.smallish')
+    version_download_path = None
     archive_type = select_archive_type(app, archive_type)
     archive_extension = get_archive_extension(archive_type)
+    version_row_suffixes = get_version_row_suffixes(archive_type)
+    # rows that aren't usable are common, so they're skipped quietly rather than raising for each one
     for version_row in versions:
-        row_number += 1
-        try:
-            columns = version_row.find_all('td')
-            version_field = columns[0]
-            if len(version_field) != 1:
-                raise AtlassianSourceDownloadError("Version field not found.")
-            version_text = version_field.text.strip()
-            if len(version_text) == 0:
-                raise AtlassianSourceDownloadError("Version field contained no text.")
-            version_name_match = VERSION_EXTRACT_REGEX.match(version_text)
-            if version_name_match is None:
-                raise AtlassianSourceDownloadError("Couldn't match version number in field.")
-            version_archive_type = version_name_match.group('type').lower()
-            if version_archive_type != archive_extension:
-                raise AtlassianSourceDownloadError("Archive type didn't match required type.")
-            download_link_field = columns[-1].find('a')
-            if len(download_link_field) != 1:
-                raise AtlassianSourceDownloadError("Download link field not found or has multiple.")
-            download_path = download_link_field.get('href').strip()
-            if len(download_path) == 0:
-                raise AtlassianSourceDownloadError("Download link URL contained no value.")
-            version_download_map[version_name_match.group('version')] = download_path
-        except AtlassianSourceDownloadError as ex:
-            # print("Skipped row number %d. Reason: %s" % (row_number, ex))
-            pass
+        version_field = version_row.select_one('td:first-of-type')
+        if version_field is None or len(version_field) != 1:
+            # version field not found
+            continue
+        version_text = version_field.text.strip()
+        if not version_text.endswith(version_row_suffixes):
+            # empty, or the archive type didn't match the required type
+            continue
+        version_name_match = VERSION_EXTRACT_REGEX.match(version_text)
+        if version_name_match is None or version_name_match.group('version') != version:
+            # not a version number, or not the version we're after
+            continue
+        download_link_field = version_row.select_one('td:last-of-type a')
+        if download_link_field is None or len(download_link_field) != 1:
+            # download link field not found or has multiple
+            continue
+        download_path = download_link_field.get('href', '').strip()
+        if len(download_path) == 0:
+            # download link URL contained no value
+            continue
+        # no need to look through the rest of the table once we've found the version we want
+        version_download_path = download_path
+        break
     # blow up if the version requested isn't in the list
-    if version not in version_download_map:
+    if version_download_path is None:
         raise AtlassianSourceDownloadError("Unable to find version '%s' on Atlassian source site."
                                            % version)
     # set the default unpack dir if it wasn't provided and create it if it doesn't exist
     if base_unpack_dir is None:
-        base_unpack_dir = '%s/versions' % os.getcwd()
-    else:
-        base_unpack_dir = base_unpack_dir.rstrip(os.path.sep)
+        base_unpack_dir = os.path.join(os.getcwd(), 'versions')
     os.makedirs(base_unpack_dir, exist_ok=True)
     # find the specified version in the list and download it
-    version_dir_path = '%s/%s/%s' % (base_unpack_dir, app, version)
-    source_archive_name = '%s/%s_%s.%s' % (base_unpack_dir, app, version, archive_extension)
+    version_dir_path = os.path.join(base_unpack_dir, app, version)
+    source_archive_name = os.path.join(base_unpack_dir,
+                                       '%s_%s.%s' % (app, version, archive_extension))
     if clean and os.path.isfile(source_archive_name):
         os.unlink(source_archive_name)
-    if not os.path.isfile(source_archive_name):
-        source_download_url = MY_ATLASSIAN + version_download_map[version]
-        browser.open(source_download_url)
-        with open(source_archive_name, 'wb') as source_archive_file:
-            source_archive_file.write(browser.response.content)
-    with get_archive_object(archive_type, source_archive_name) as src:
-        os.makedirs(version_dir_path, exist_ok=True)
-        top_dirs = list(set(d.split(os.path.sep)[0] for d in src.namelist()))
+    # unpack the archive to a temporary location that we can move from later if all goes well. it
+    # lives next to the version directory so that the move is a rename rather than a full copy.
+    app_dir_path = os.path.dirname(version_dir_path)
+    os.makedirs(app_dir_path, exist_ok=True)
+    archive_extraction_dir = mkdtemp(prefix='.unpack_', dir=app_dir_path)
+    try:
+        source_download_url = MY_ATLASSIAN + version_download_path
+        if archive_type == 'tar':
+            if os.path.isfile(source_archive_name):
+                extract_tar_file(source_archive_name, archive_extraction_dir)
+            else:
+                # gzipped tarballs can be unpacked as they download, so only write them out to keep
+                stream_tar_archive(_SESSION, source_download_url, archive_extraction_dir,
+                                   source_archive_name if keep else None)
+        else:
+            if not os.path.isfile(source_archive_name):
+                # zip archives keep their index at the end, so they have to be on disk to unpack
+                download_archive(_SESSION, source_download_url, source_archive_name)
+            extract_archive(archive_type, source_archive_name, archive_extraction_dir)
+        # rather than listing the archive up front, look at what it unpacked into
+        top_dirs = os.listdir(archive_extraction_dir)
         if len(top_dirs) != 1:
             raise AtlassianSourceDownloadError("Couldn't unpack archive - unexpected contents.")
-        # extract the archive to a temporary location that we can move from later if all goes well
         top_level_dir_name = top_dirs[0]
-        archive_extraction_dir = mkdtemp()
-        try:
-            # unpack the archive to the temporary folder
-            src.extractall(archive_extraction_dir)
-            # remove the target directory if it already exists
-            if os.path.isdir(version_dir_path):
-                shutil.rmtree(version_dir_path)
-            shutil.move(os.path.join(archive_extraction_dir, top_level_dir_name), version_dir_path)
-        finally:
-            shutil.rmtree(archive_extraction_dir)
-    if not keep:
+        # remove the target directory if it already exists
+        if os.path.isdir(version_dir_path):
+            shutil.rmtree(version_dir_path)
+        os.rename(os.path.join(archive_extraction_dir, top_level_dir_name), version_dir_path)
+    finally:
+        shutil.rmtree(archive_extraction_dir)
+    if not keep and os.path.isfile(source_archive_name):
         os.unlink(source_archive_name)
     # now that we've got the source, return the path it lives at
     return version_dir_path
\ No newline at end of file
@@ -1,25 +1,35 @@
 import os
+import re
 import tempfile
 import traceback
-from pkg_resources import resource_string
+from pkgutil import get_data
+from functools import lru_cache
 from mavpy import Maven, get_maven_name, env_var
 from argparse import ArgumentParser, ArgumentTypeError, ArgumentError
-from distutils.version import StrictVersion
+from packaging.version import Version, InvalidVersion
 from atlassiansourcegen.downloader import get_source
 
 
-VALID_APPS = ['crowd', 'jira', 'confluence', 'stash', 'bamboo', 'fisheye', 'crucible']
+VALID_APPS = frozenset(['crowd', 'jira', 'confluence', 'stash', 'bamboo', 'fisheye', 'crucible'])
 APP_BUILD_DIRS = {'jira':       'jira-project',
                   'confluence': 'confluence-project',
                   'stash':      'stash-parent'}
+SETTINGS_PLACEHOLDER_REGEX = re.compile(r'ATLAS_ARTIFACT_REPO_(?P<field>USER|PASS)')
+MAVEN_DIR_VERSION_REGEX = re.compile(r'\d+(\.\d+)*')
 
 
 def check_semantic_version(value):
     try:
-        StrictVersion(value)
-        return value
-    except ValueError:
+        version = Version(value)
+    except InvalidVersion:
+        version = None
+    # packaging accepts far more than the plain x.y[.z] releases Atlassian publishes source for, so
+    # only take values that are already in that form
+    if (version is None or str(version) != value or len(version.release) not in [2, 3] or
+            version.epoch != 0 or version.is_prerelease or version.is_postrelease or
+            version.local is not None):
         raise ArgumentTypeError("Invalid version number: %s" % value)
+    return value
 
 
 def check_atlassian_app(value):
@@ -71,15 +81,30 @@ def get_cmdline_args():
     return args
 
 
+@lru_cache(maxsize=1)
+def get_settings_template():
+    return get_data('atlassiansourcegen', 'resources/deploy-settings.xml').decode("utf-8")
+
+
+def get_maven_dir_sort_key(maven_dir):
+    # compare versions numerically so that e.g. maven-3.10 sorts after maven-3.2
+    maven_dir_name = os.path.basename(maven_dir)
+    version_match = MAVEN_DIR_VERSION_REGEX.search(maven_dir_name)
+    return Version('0' if version_match is None else version_match.group(0)), maven_dir_name
+
+
 def make_settings_file(username=None, password=None):
-    _, file_path = tempfile.mkstemp(prefix='deployment_settings_', suffix='.xml', text=True)
-    settings_file = resource_string('atlassiansourcegen', 'resources/deploy-settings.xml')
-    settings_file = settings_file.decode("utf-8")
-    if username is not None:
-        settings_file = settings_file.replace('ATLAS_ARTIFACT_REPO_USER', username)
-    if password is not None:
-        settings_file = settings_file.replace('ATLAS_ARTIFACT_REPO_PASS', password)
-    with open(file_path, 'w') as handle:
+    settings_file = get_settings_template()
+    # fill in both placeholders in one pass, leaving any we weren't given a value for as they are
+    values = {'USER': username, 'PASS': password}
+
+    def fill_placeholder(match):
+        value = values[match.group('field')]
+        return match.group(0) if value is None else value
+
+    settings_file = SETTINGS_PLACEHOLDER_REGEX.sub(fill_placeholder, settings_file)
+    fd, file_path = tempfile.mkstemp(prefix='deployment_settings_', suffix='.xml', text=True)
+    with os.fdopen(fd, 'w') as handle:
         handle.write(settings_file)
     return file_path
 
@@ -108,16 +133,20 @@ def run():
                          keep=args.discard_source)
     settings_path = None
     build_success = False
-    maven_dirs = [os.path.join(src_dir, d) for d in os.listdir(src_dir) if d.startswith('maven')]
-    atlas_maven_path = os.path.sep.join([args.sdk_path, 'bin', 'atlas-mvn'])
+    with os.scandir(src_dir) as src_entries:
+        maven_dirs = [entry.path for entry in src_entries
+                      if entry.name.startswith('maven') and entry.is_dir()]
+    atlas_maven_path = os.path.join(args.sdk_path, 'bin', 'atlas-mvn')
+    maven_name = get_maven_name()
     try:
         settings_path = make_settings_file(args.repo_user, args.repo_pass)
         # should try newer maven versions first and fall back to older ones if it the new ones fail
-        for maven_dir in reversed(sorted(maven_dirs)):
+        for maven_dir in sorted(maven_dirs, key=get_maven_dir_sort_key, reverse=True):
             try:
                 # should contain only one directory - assumption may prove incorrect
-                maven_real_dir = os.path.join(maven_dir.rstrip(os.path.sep), os.listdir(maven_dir)[0])
-                maven_bin_path = os.path.join(maven_real_dir, 'bin', get_maven_name())
+                with os.scandir(maven_dir) as maven_entries:
+                    maven_real_dir = next(maven_entries).path
+                maven_bin_path = os.path.join(maven_real_dir, 'bin', maven_name)
                 with env_var('ATLAS_MVN', maven_bin_path):
                     maven = Maven(atlas_maven_path, os.path.join(src_dir, APP_BUILD_DIRS[args.app]))
                     maven.options('-s %s' % settings_path, '-U')
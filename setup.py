@@ -11,12 +11,13 @@ setup(name='atlassiansourcegen',
                    'Intended Audience :: System Administrators',
                    'License :: OSI Approved :: IBM Public License',
                    'Operating System :: POSIX :: Linux',
-                   'Programming Language :: Python :: 3.4',
+                   'Programming Language :: Python :: 3.6',
                    'Programming Language :: Java',
                    'Topic :: Software Development :: Build Tools'],
       url='https://github.com/SPoage/atlas-source-jar-gen',
       author='Shane Poage',
+      python_requires='>=3.6',
       packages=find_packages(),
       entry_points={'console_scripts': ['atlas-source-gen=atlassiansourcegen.main:run']},
-      package_data={'atlassiansourcegen': ['resource/deploy-settings.xml']},
-      install_requires=['mavpy', 'robobrowser'])
\ No newline at end of file
+      package_data={'atlassiansourcegen': ['resources/deploy-settings.xml']},
+      install_requires=['mavpy', 'requests', 'beautifulsoup4', 'lxml', 'packaging'])
\ No newline at end of file